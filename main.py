@@ -1,20 +1,69 @@
 import os
 import requests
-import base64
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import yfinance as yf
 from datetime import datetime
 from dotenv import load_dotenv
 import csv
-import re
+import shutil
+import tempfile
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import hashlib
+import functools
+import random
+import time
+import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Retrieve the GitHub token from environment variables once, at import time.
+load_dotenv()
+GITHUB_TOKEN = os.getenv('TOKEN')
+AUTH_HEADERS = {
+    'Authorization': f'token {GITHUB_TOKEN}',
+    'Accept': 'application/vnd.github+json'
+}
+
+# The repository and branch the CSVs are committed to, and its Git Data API base URL.
+REPO = 'awakzdev/finance-data'
+BRANCH = 'main'
+GIT_API = f'https://api.github.com/repos/{REPO}/git'
+COMMIT_MESSAGE = 'Update {} stock data'
+
+# Symbols to process
+SYMBOLS = ['QLD', '^NDX']
+
+# Names and file paths derived from a symbol, built once per run.
+SymbolConfig = namedtuple('SymbolConfig', ['symbol', 'name', 'csv_filename', 'digest_filename'])
+
+# First date of the full history, used when no usable local CSV exists.
+HISTORY_START = '2006-06-21'
+
+# Above this many symbols, the per-symbol formatting runs in processes rather than threads.
+PROCESS_POOL_THRESHOLD = 8
+
+# Matches dates in dd/mm/yyyy format.
+DATE_PATTERN = r'\d{2}/\d{2}/\d{4}'
 
 def normalize_header(header_row):
     """Trim whitespace from each column in the header row."""
     return [col.strip() for col in header_row]
 
-def validate_and_fix_csv(csv_filename):
+def is_ddmmyyyy(value):
+    """Check whether value is a date in dd/mm/yyyy format without the regex engine."""
+    return (len(value) == 10 and value[2] == '/' and value[5] == '/'
+            and value[0:2].isdigit() and value[3:5].isdigit() and value[6:10].isdigit())
+
+def repair_csv_file(csv_filename):
     """
-    Validates the CSV format and fixes it if corrupted.
+    Validates the CSV format row by row and fixes it if corrupted.
     
     The correct format should have the header:
     Date,Open,High,Low,Close,Adj Close,Volume
@@ -29,174 +78,652 @@ def validate_and_fix_csv(csv_filename):
         bool: True if the CSV was valid or successfully fixed, False otherwise.
     """
     expected_header = ['Date', 'Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
-    date_pattern = re.compile(r'\d{2}/\d{2}/\d{4}')  # Matches dd/mm/yyyy
+
+    # Valid rows are streamed into a temporary file next to the CSV, which then
+    # atomically replaces it, so the file is never held in memory as a whole.
+    csv_dir = os.path.dirname(os.path.abspath(csv_filename))
+    temp_filename = None
 
     try:
-        with open(csv_filename, 'r', newline='', encoding='utf-8') as infile:
+        with open(csv_filename, 'r', newline='', encoding='utf-8') as infile, \
+                tempfile.NamedTemporaryFile('w', dir=csv_dir, delete=False, newline='',
+                                            encoding='utf-8') as outfile:
+            temp_filename = outfile.name
             reader = csv.reader(infile)
-            lines = list(reader)
+            writer = csv.writer(outfile)
 
-        # Debug: Print the first few lines of the CSV for inspection
-        print(f"Debug: First 3 lines from {csv_filename}:")
-        for line in lines[:3]:
-            print(line)
+            # Debug: Collect the first few lines of the CSV for inspection
+            first_lines = []
+            header_index = -1
+            data_rows = 0
 
-        # Find the index where the correct header starts (using normalization)
-        header_index = -1
-        for i, row in enumerate(lines):
-            if normalize_header(row) == expected_header:
-                header_index = i
-                break
+            for i, row in enumerate(reader):
+                if i < 3:
+                    first_lines.append(row)
 
-        if header_index == -1:
-            print(f"Header not found in {csv_filename}. The file may be corrupted.")
-            return False
+                # Find the row where the correct header starts (using normalization)
+                if header_index == -1:
+                    if normalize_header(row) == expected_header:
+                        header_index = i
+                        writer.writerow(row)
+                    continue
 
-        # Debug: Print the header row found
-        print(f"Header found in {csv_filename} at line {header_index}: {lines[header_index]}")
+                # Validate data rows: stop reading after the first invalid row.
+                if not row:
+                    continue  # Skip empty lines
+                if is_ddmmyyyy(row[0]):
+                    if len(row) == len(expected_header):
+                        writer.writerow(row)
+                        data_rows += 1
+                    else:
+                        log.warning("Skipping row with incorrect number of columns: %s", row)
+                else:
+                    log.warning("Encountered non-data row: %s. Discarding all subsequent lines.", row)
+                    break
 
-        # Extract the relevant rows starting from the header
-        valid_rows = lines[header_index:]
+        log.debug("First 3 lines from %s: %s", csv_filename, first_lines)
 
-        # Verify that there is at least one data row
-        if len(valid_rows) < 2:
-            print(f"No data found after header in {csv_filename}.")
+        if header_index == -1:
+            log.error("Header not found in %s. The file may be corrupted.", csv_filename)
             return False
 
-        # Validate data rows: stop reading after the first invalid row.
-        valid_data = [valid_rows[0]]  # Include the header
-        for row in valid_rows[1:]:
-            if not row:
-                continue  # Skip empty lines
-            if date_pattern.match(row[0]):
-                if len(row) == len(expected_header):
-                    valid_data.append(row)
-                else:
-                    print(f"Skipping row with incorrect number of columns: {row}")
-            else:
-                print(f"Encountered non-data row: {row}. Discarding all subsequent lines.")
-                break
+        # Log the line the header was found at
+        log.debug("Header found in %s at line %d.", csv_filename, header_index)
 
-        if len(valid_data) < 2:
-            print(f"No valid data found in {csv_filename}.")
+        if data_rows == 0:
+            log.error("No valid data found in %s.", csv_filename)
             return False
 
-        # Rewrite the CSV with valid data only
-        with open(csv_filename, 'w', newline='', encoding='utf-8') as outfile:
-            writer = csv.writer(outfile)
-            writer.writerows(valid_data)
+        # Replace the CSV with valid data only, keeping its permissions
+        shutil.copymode(csv_filename, temp_filename)
+        os.replace(temp_filename, csv_filename)
+        temp_filename = None
 
-        print(f"CSV {csv_filename} validated and fixed successfully.")
+        log.info("CSV %s validated and fixed successfully.", csv_filename)
         return True
 
     except Exception as e:
-        print(f"An error occurred while validating {csv_filename}: {e}")
+        log.error("An error occurred while validating %s: %s", csv_filename, e)
+        return False
+
+    finally:
+        if temp_filename and os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+def validate_data(data):
+    """
+    Validates formatted data before it is written as CSV or after it is read back.
+
+    The data must have the numeric columns Open,High,Low,Close,Adj Close,Volume
+    (in that order) and an index of dates in dd/mm/yyyy format, so the CSV matches
+    the format checked by repair_csv_file() without a per-row pass over the file.
+
+    Args:
+        data (pd.DataFrame): The data to validate.
+
+    Returns:
+        bool: True if the data is valid, False otherwise.
+    """
+    expected_cols = ['Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
+    if list(data.columns) != expected_cols:
+        log.error("Unexpected columns: %s", list(data.columns))
+        return False
+
+    non_numeric = [col for col in expected_cols if not pd.api.types.is_numeric_dtype(data[col])]
+    if non_numeric:
+        log.error("Found non-numeric values in columns: %s", non_numeric)
+        return False
+
+    if data.empty:
+        log.error("No data rows found.")
+        return False
+
+    # A single vectorized regex pass over the whole index.
+    if not data.index.str.match(DATE_PATTERN).all():
+        log.error("Found dates not in dd/mm/yyyy format.")
+        return False
+
+    return True
+
+@functools.lru_cache(maxsize=1)
+def get_session():
+    """
+    Returns the requests session shared by all GitHub API calls.
+
+    Reusing one session keeps the connection to api.github.com alive, so
+    every request after the first skips the TCP and TLS handshakes. The
+    session is built on the first call and returned as-is afterwards.
+
+    Returns:
+        requests.Session: A session with the auth headers and retries configured.
+    """
+    session = requests.Session()
+    session.headers.update(AUTH_HEADERS)
+    # Rate limits and transient server errors are retried with exponential
+    # backoff, waiting as long as GitHub's Retry-After header asks. POST and
+    # PATCH are safe to repeat here: blobs and trees are content-addressed, so
+    # a repeat returns the same object. A repeated commit gets a new timestamp
+    # and SHA, but only the commit passed to the ref update is published, so
+    # any duplicate is left dangling. The ref update itself sets an absolute
+    # SHA. raise_on_status=False hands the last response to call_github_api()
+    # so its error message includes the body.
+    retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=['GET', 'POST', 'PATCH'], respect_retry_after_header=True,
+                    raise_on_status=False)
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries))
+    return session
+
+def download_history(symbols, start_date, end_date, attempts=3):
+    """
+    Downloads daily bars for all symbols in a single Yahoo request.
+
+    yfinance logs per-ticker failures instead of raising them, so a download
+    that comes back empty or without bars for one of the symbols is retried
+    with exponential backoff and jitter, as is one that raises. Yahoo rate
+    limits usually clear within a few seconds. The range always starts on a
+    day that has a bar, so a healthy response is never empty.
+
+    Args:
+        symbols (list): The ticker symbols to download.
+        start_date (str): The first date to download (YYYY-MM-DD).
+        end_date (str): The exclusive end date of the download (YYYY-MM-DD).
+        attempts (int): How many times to try the download.
+
+    Returns:
+        pd.DataFrame: The bars grouped by ticker, or None if all attempts failed.
+    """
+    for attempt in range(attempts):
+        try:
+            bulk = yf.download(' '.join(symbols), start=start_date, end=end_date,
+                               group_by='ticker', threads=True, progress=False)
+        except Exception as e:
+            log.warning("Download failed for symbols: %s (attempt %d/%d): %s", ', '.join(symbols), attempt + 1, attempts, e)
+        else:
+            missing = [symbol for symbol in symbols if get_symbol_data(bulk, symbol) is None]
+            if not missing:
+                return bulk
+            log.warning("No data returned for symbols: %s (attempt %d/%d)", ', '.join(missing), attempt + 1, attempts)
+        if attempt < attempts - 1:
+            time.sleep(2 ** attempt + random.random())
+    log.error("Giving up on downloading symbols: %s after %d attempts.", ', '.join(symbols), attempts)
+    return None
+
+def get_symbol_config(symbol):
+    """
+    Derives the names and file paths used for a symbol.
+
+    For example, '^NDX' is committed as 'NDX' to 'ndx_stock_data.csv', and the
+    SHA-256 of its last uploaded CSV is recorded in '.ndx.sha256'.
+
+    Args:
+        symbol (str): The ticker symbol (e.g. 'QLD', '^NDX').
+
+    Returns:
+        SymbolConfig: The symbol with its display name and file paths.
+    """
+    name = symbol.replace('^', '')
+    return SymbolConfig(symbol, name, f'{name.lower()}_stock_data.csv', f'.{name.lower()}.sha256')
+
+def load_digest(digest_filename):
+    """Return the digest stored in digest_filename, or None if there is none."""
+    if not os.path.exists(digest_filename):
+        return None
+    with open(digest_filename, 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
+def save_digest(digest_filename, content):
+    """Record the SHA-256 of content, once the repository is known to hold it."""
+    with open(digest_filename, 'w', encoding='utf-8') as f:
+        f.write(hashlib.sha256(content).hexdigest() + '\n')
+
+def git_blob_sha(content):
+    """Return the git blob SHA of content, as listed in the repository's git trees."""
+    return hashlib.sha1(f'blob {len(content)}\0'.encode('utf-8') + content).hexdigest()
+
+def call_github_api(session, method, url, payload=None):
+    """
+    Sends a request to the GitHub API and returns its decoded JSON response.
+
+    Args:
+        session (requests.Session): The shared, authenticated GitHub API session.
+        method (str): The HTTP method, e.g. 'GET' or 'POST'.
+        url (str): The API URL.
+        payload (dict): The JSON body of the request, if any.
+
+    Returns:
+        dict: The decoded JSON response.
+
+    Raises:
+        RuntimeError: If GitHub answers with an unexpected status code.
+    """
+    response = session.request(method, url, json=payload)
+    if response.status_code not in [200, 201]:
+        raise RuntimeError(f'Unexpected error on {method} {url}: {response.status_code} {response.text}')
+    return response.json()
+
+def fetch_branch_tree(session):
+    """
+    Fetches the head commit of BRANCH and the files at the root of its tree.
+
+    Args:
+        session (requests.Session): The shared, authenticated GitHub API session.
+
+    Returns:
+        tuple: The head commit SHA, its tree SHA, and a dict mapping each file
+        at the root of the tree to its blob SHA.
+    """
+    commit_sha = call_github_api(session, 'GET', f'{GIT_API}/ref/heads/{BRANCH}')['object']['sha']
+    tree_sha = call_github_api(session, 'GET', f'{GIT_API}/commits/{commit_sha}')['tree']['sha']
+    tree = call_github_api(session, 'GET', f'{GIT_API}/trees/{tree_sha}')['tree']
+    files = {entry['path']: entry['sha'] for entry in tree if entry['type'] == 'blob'}
+    return commit_sha, tree_sha, files
+
+def create_blob(session, content):
+    """
+    Uploads content as a git blob.
+
+    The CSVs are plain ASCII, so they are sent as UTF-8 text rather than
+    base64, which would inflate the request body by a third.
+
+    Args:
+        session (requests.Session): The shared, authenticated GitHub API session.
+        content (bytes): The file content.
+
+    Returns:
+        str: The SHA of the created blob.
+    """
+    payload = {
+        'content': content.decode('utf-8'),
+        'encoding': 'utf-8'
+    }
+    return call_github_api(session, 'POST', f'{GIT_API}/blobs', payload)['sha']
+
+def commit_blobs(session, head_sha, tree_sha, blobs, message):
+    """
+    Commits uploaded blobs on top of BRANCH in a single commit.
+
+    Args:
+        session (requests.Session): The shared, authenticated GitHub API session.
+        head_sha (str): The current head commit of the branch.
+        tree_sha (str): The tree of the head commit, which the new tree builds on.
+        blobs (dict): Maps each file path to the SHA of its uploaded blob.
+        message (str): The commit message.
+
+    Returns:
+        str: The SHA of the new commit.
+    """
+    tree = call_github_api(session, 'POST', f'{GIT_API}/trees', {
+        'base_tree': tree_sha,
+        'tree': [
+            {'path': path, 'mode': '100644', 'type': 'blob', 'sha': sha}
+            for path, sha in blobs.items()
+        ]
+    })
+    commit = call_github_api(session, 'POST', f'{GIT_API}/commits', {
+        'message': message,
+        'tree': tree['sha'],
+        'parents': [head_sha]
+    })
+    call_github_api(session, 'PATCH', f'{GIT_API}/refs/heads/{BRANCH}', {'sha': commit['sha']})
+    return commit['sha']
+
+def format_dates(index):
+    """
+    Formats a DatetimeIndex as dd/mm/yyyy strings.
+
+    Builds the strings with vectorized NumPy operations on the day, month and
+    year arrays, which avoids one Python-level strftime call per date.
+
+    Args:
+        index (pd.DatetimeIndex): The dates to format.
+
+    Returns:
+        pd.Index: The formatted date strings.
+    """
+    day = np.char.zfill(index.day.to_numpy().astype('U2'), 2)
+    month = np.char.zfill(index.month.to_numpy().astype('U2'), 2)
+    year = index.year.to_numpy().astype('U4')
+    return pd.Index(np.char.add(np.char.add(np.char.add(np.char.add(day, '/'), month), '/'), year))
+
+def to_csv_bytes(data):
+    """
+    Serializes formatted data as CSV with pyarrow's C++ writer.
+
+    The output matches pandas' to_csv() byte for byte, so unchanged rows keep
+    their content: the header row is written by hand because pyarrow always
+    quotes column names, whole floats get the '.0' pyarrow leaves out, floats
+    pyarrow would write in a different notation are written with repr() as
+    pandas does, and CRLF line endings match the files already committed to the
+    repository.
+
+    Args:
+        data (pd.DataFrame): The formatted data, indexed by dd/mm/yyyy date strings.
+
+    Returns:
+        bytes: The CSV content, with the header Date,Open,High,Low,Close,Adj Close,Volume.
+    """
+    header = ','.join(['Date'] + list(data.columns)) + '\r\n'
+    table = pa.Table.from_pandas(data.rename_axis('Date').reset_index(), preserve_index=False)
+
+    columns = []
+    for column in table.columns:
+        if pa.types.is_floating(column.type):
+            text = pc.cast(column, pa.string())
+            whole = pc.invert(pc.match_substring_regex(text, '[.en]'))
+            text = pc.if_else(whole, pc.binary_join_element_wise(text, '.0', ''), text)
+            # pyarrow and repr() only agree on magnitudes from 1e-4 up to 1e10,
+            # so the rare values outside that range are formatted with repr().
+            magnitude = pc.abs(column)
+            outside = pc.or_(pc.and_(pc.less(magnitude, 1e-4), pc.not_equal(magnitude, 0)),
+                             pc.greater_equal(magnitude, 1e10))
+            rows = np.flatnonzero(pc.fill_null(outside, False).to_numpy())
+            if len(rows):
+                strings = text.to_pylist()
+                for row in rows:
+                    strings[row] = repr(column[row].as_py())
+                text = pa.array(strings, pa.string())
+            column = text
+        columns.append(column)
+    table = pa.table(columns, names=table.column_names)
+
+    buffer = pa.BufferOutputStream()
+    write_options = pacsv.WriteOptions(include_header=False, quoting_style='none', eol='\r\n')
+    pacsv.write_csv(table, buffer, write_options=write_options)
+    return header.encode('utf-8') + buffer.getvalue().to_pybytes()
+
+def read_csv_data(csv_filename):
+    """
+    Reads a CSV written by process_symbol() back into a DataFrame.
+
+    Args:
+        csv_filename (str): The path to the CSV file.
+
+    Returns:
+        pd.DataFrame: The rows indexed by their dd/mm/yyyy date strings, or None if
+        the file could not be parsed.
+    """
+    try:
+        # round_trip keeps the cached floats byte-identical when they are written back.
+        data = pd.read_csv(csv_filename, index_col='Date', dtype={'Date': str},
+                           float_precision='round_trip')
+    except Exception as e:
+        log.warning("Could not read %s: %s", csv_filename, e)
+        return None
+    return data
+
+def get_symbol_data(bulk, symbol):
+    """
+    Extracts one symbol's bars from a batched Yahoo download.
+
+    Args:
+        bulk (pd.DataFrame): The result of download_history().
+        symbol (str): The ticker symbol to extract.
+
+    Returns:
+        pd.DataFrame: The symbol's bars, or None if Yahoo returned none for it.
+    """
+    if bulk.empty:
+        return None
+    if isinstance(bulk.columns, pd.MultiIndex):
+        if symbol not in bulk.columns.get_level_values(0):
+            return None
+        bulk = bulk[symbol]
+    data = bulk.dropna(how='all').copy()
+    return data if not data.empty else None
+
+def is_cache_current(cached, data):
+    """
+    Checks cached bars against a fresh download of the last cached day.
+
+    Yahoo adjusts the whole price history after dividends and splits. If the
+    Close of the last cached day no longer matches, the cached rows are on a
+    stale adjustment basis and new bars cannot simply be appended to them.
+
+    Args:
+        cached (pd.DataFrame): The rows loaded by load_cached_data().
+        data (pd.DataFrame): The symbol's fresh bars, starting at or before the last cached day.
+
+    Returns:
+        bool: True if the cached Close of the last cached day is unchanged, False otherwise.
+    """
+    last_date = cached.index.max()
+    if last_date not in data.index:
         return False
+    return bool(np.isclose(data.at[last_date, 'Close'], cached.at[last_date, 'Close'], rtol=1e-9, atol=0))
+
+def load_cached_data(csv_filename):
+    """
+    Loads the CSV written by a previous run so only newer rows need downloading.
+
+    The cache is ignored if it is missing or unreadable. Whether its prices are
+    still current is checked against Yahoo by is_cache_current().
+
+    Args:
+        csv_filename (str): The path to the previously written CSV file.
+
+    Returns:
+        pd.DataFrame: The cached rows indexed by date, or None if there is no usable cache.
+    """
+    if not os.path.exists(csv_filename):
+        return None
+
+    # Validate the file through the loaded DataFrame, which needs no per-row
+    # Python work. The row-by-row repair only runs if that fails, e.g. for a
+    # file left truncated or with stray lines.
+    cached = read_csv_data(csv_filename)
+    if cached is None or not validate_data(cached):
+        log.warning("Cached %s failed validation, repairing it.", csv_filename)
+        if not repair_csv_file(csv_filename):
+            log.warning("Cached %s is corrupted, ignoring it.", csv_filename)
+            return None
+        cached = read_csv_data(csv_filename)
+        if cached is None or not validate_data(cached):
+            return None
+
+    cached.index = pd.to_datetime(cached.index, format='%d/%m/%Y')
+    return cached
+
+def process_symbol(config, data, cached):
+    """
+    Formats and validates the CSV for a single symbol and saves a local copy.
+
+    Args:
+        config (SymbolConfig): The symbol to process, from get_symbol_config().
+        data (pd.DataFrame): The symbol's new rows from the batched Yahoo download.
+        cached (pd.DataFrame): The rows loaded by load_cached_data(), or None.
+
+    Returns:
+        bytes: The CSV content to upload, the cached CSV if there are no new
+            rows, or None if there is nothing to upload.
+    """
+    try:
+        # Step 2: Check the historical data fetched for the symbol
+        if data.empty:
+            if cached is None:
+                log.error("No data fetched for symbol: %s", config.symbol)
+                return None
+            # The local copy is saved before the upload, so after a failed
+            # upload it is ahead of the repository. Return it unchanged and
+            # let the digest and branch checks decide whether to upload it.
+            log.info("No new data for symbol: %s", config.symbol)
+            with open(config.csv_filename, 'rb') as f:
+                return f.read()
+
+        # Flatten multi-index columns if necessary
+        if isinstance(data.columns, pd.MultiIndex):
+            data.columns = data.columns.get_level_values(0)
+
+        # Adjust columns to match the expected CSV format:
+        # Expected header: Date,Open,High,Low,Close,Adj Close,Volume
+        # For example, for QLD the DataFrame might have: Price, Close, High, Low, Open, Volume
+        # Remove the 'Price' column if it exists.
+        if 'Price' in data.columns:
+            data.drop(columns='Price', inplace=True)
+        
+        # Create 'Adj Close' if it's not present (using 'Close' as a fallback)
+        if 'Adj Close' not in data.columns:
+            data['Adj Close'] = data['Close']
+        
+        # Reorder the columns to match the expected header.
+        expected_cols = ['Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
+        data = data[expected_cols]
+
+        # The batched download turns Volume into floats when it has to align the
+        # symbols' dates; restore whole numbers so the CSV rows keep their format.
+        if data['Volume'].notna().all():
+            data = data.astype({'Volume': 'int64'})
+
+        # Append the new rows to the cached history.
+        if cached is not None:
+            data = pd.concat([cached[expected_cols], data])
+
+        # Convert the index (dates) to the desired format (dd/mm/yyyy)
+        data.index = format_dates(data.index)
+        
+        csv_filename = config.csv_filename
+
+        # Step 3: Validate the data before it is written.
+        if not validate_data(data):
+            log.error("Skipping upload for %s due to validation failure.", csv_filename)
+            return None  # Skip uploading this file
+
+        # Step 4: Save the data to a CSV file with the symbol as a prefix.
+        content = to_csv_bytes(data)
+
+        # Keep a local copy, which the next run loads as its cache.
+        with open(csv_filename, 'wb') as f:
+            f.write(content)
+        log.info("CSV %s saved successfully.", csv_filename)
+        return content
+
+    except Exception as e:
+        log.error("An error occurred while processing symbol %s: %s", config.symbol, e)
+        return None
 
 def main():
-    # Retrieve the GitHub token from environment variables
-    load_dotenv()
-    github_token = os.getenv('TOKEN')
-    if not github_token:
+    if not GITHUB_TOKEN:
         raise ValueError("TOKEN environment variable not set")
     else:
-        print(f"TOKEN loaded, length: {len(github_token)} characters")
-    
-    repo = 'awakzdev/finance-data'
-    branch = 'main'
+        log.info("TOKEN loaded, length: %d characters", len(GITHUB_TOKEN))
     
     # Step 1: Fetch today's date in the format YYYY-MM-DD
     today_date = datetime.now().strftime('%Y-%m-%d')
     
-    # Symbols to process
-    symbols = ['QLD', '^NDX']
+    # Derive each symbol's names and file paths once, up front.
+    symbols = SYMBOLS
+    configs = {symbol: get_symbol_config(symbol) for symbol in symbols}
+
+    # A single session is shared by every thread so they reuse its connections.
+    session = get_session()
     
-    for symbol in symbols:
-        try:
-            # Step 2: Fetch historical data for the symbol
-            print(f"Fetching data for symbol: {symbol}")
-            data = yf.download(symbol, start='2006-06-21', end=today_date)
-            if data.empty:
-                print(f"No data fetched for symbol: {symbol}")
+    # Load the CSVs written by the previous run so only the missing days
+    # are downloaded. The download starts on the last cached day so that day
+    # can be compared with the cache. A symbol without a usable cache needs
+    # the full history.
+    cached = {symbol: load_cached_data(configs[symbol].csv_filename) for symbol in symbols}
+    if all(df is not None for df in cached.values()):
+        start_date = min(df.index.max() for df in cached.values()).strftime('%Y-%m-%d')
+    else:
+        start_date = HISTORY_START
+
+    # Fetch historical data for all symbols in a single Yahoo request.
+    log.info("Fetching data for symbols: %s from %s", ', '.join(symbols), start_date)
+    bulk = download_history(symbols, start_date, today_date)
+    if bulk is None:
+        # A failed download is not the same as a range without new bars;
+        # stop rather than report every symbol as having no new data.
+        log.error("Could not fetch data for symbols: %s, nothing to upload.", ', '.join(symbols))
+        return
+    fetched = {symbol: get_symbol_data(bulk, symbol) for symbol in symbols}
+
+    # A cache whose last day Yahoo has since re-adjusted is dropped and the
+    # symbol's full history is downloaded again. download_history() already
+    # retried any symbol it did not return, so a missing symbol is a failed
+    # download, not a stale cache.
+    stale = [
+        symbol for symbol in symbols
+        if cached[symbol] is not None and fetched[symbol] is not None
+        and not is_cache_current(cached[symbol], fetched[symbol])
+    ]
+    if stale:
+        log.warning("Cached history of %s no longer matches Yahoo, downloading it in full.", ', '.join(stale))
+        full = download_history(stale, HISTORY_START, today_date)
+        for symbol in stale:
+            cached[symbol] = None
+            fetched[symbol] = get_symbol_data(full, symbol) if full is not None else None
+
+    # The per-symbol work is CPU-bound pandas and pyarrow formatting. Threads
+    # are enough for a few symbols, but past PROCESS_POOL_THRESHOLD the GIL
+    # caps them, so each symbol gets its own process instead.
+    if len(symbols) > PROCESS_POOL_THRESHOLD:
+        pool = ProcessPoolExecutor()
+    else:
+        pool = ThreadPoolExecutor(max_workers=len(symbols))
+    with pool:
+        futures = {}
+        for symbol in symbols:
+            data = fetched[symbol]
+            if data is None:
+                log.error("No data fetched for symbol: %s", symbol)
                 continue
+            if cached[symbol] is not None:
+                data = data[data.index > cached[symbol].index.max()]
+            futures[symbol] = pool.submit(process_symbol, configs[symbol], data, cached[symbol])
+        contents = {symbol: future.result() for symbol, future in futures.items()}
+
+    # Step 5: Skip CSVs identical to the last ones known to be in the
+    # repository. If none are left, GitHub is not contacted at all.
+    candidates = {}
+    for symbol, content in contents.items():
+        if content is None:
+            continue
+        config = configs[symbol]
+        if hashlib.sha256(content).hexdigest() == load_digest(config.digest_filename):
+            log.info("File %s unchanged since the last upload, skipping it.", config.csv_filename)
+        else:
+            candidates[symbol] = content
 
-            # Flatten multi-index columns if necessary
-            if isinstance(data.columns, pd.MultiIndex):
-                data.columns = data.columns.get_level_values(0)
-
-            # Convert the index (dates) to the desired format (dd/mm/yyyy)
-            data.index = data.index.strftime('%d/%m/%Y')
-            
-            # Adjust columns to match the expected CSV format:
-            # Expected header: Date,Open,High,Low,Close,Adj Close,Volume
-            # For example, for QLD the DataFrame might have: Price, Close, High, Low, Open, Volume
-            # Remove the 'Price' column if it exists.
-            if 'Price' in data.columns:
-                data.drop(columns='Price', inplace=True)
-            
-            # Create 'Adj Close' if it's not present (using 'Close' as a fallback)
-            if 'Adj Close' not in data.columns:
-                data['Adj Close'] = data['Close']
-            
-            # Reorder the columns to match the expected header.
-            expected_cols = ['Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
-            data = data[expected_cols]
-            
-            # Step 3: Save the data to a CSV file with the symbol as a prefix.
-            sanitized_symbol = symbol.replace('^', '')
-            csv_filename = f'{sanitized_symbol.lower()}_stock_data.csv'
-            
-            # Write CSV with "Date" as the index label so the header becomes:
-            # Date,Open,High,Low,Close,Adj Close,Volume
-            data.to_csv(csv_filename, index=True, index_label='Date')
-            print(f"CSV {csv_filename} saved successfully.")
-
-            # Step 4: Validate and fix the CSV if necessary.
-            if not validate_and_fix_csv(csv_filename):
-                print(f"Skipping upload for {csv_filename} due to validation failure.")
-                continue  # Skip uploading this file
-
-            # Step 5: Get the current file's SHA from GitHub (if it exists)
-            url = f'https://api.github.com/repos/{repo}/contents/{csv_filename}'
-            headers = {'Authorization': f'token {github_token}'}
-            response = requests.get(url, headers=headers)
-            response_json = response.json()
-
-            if response.status_code == 200:
-                sha = response_json['sha']
-                print(f'File {csv_filename} exists, updating it.')
-            elif response.status_code == 404:
-                sha = None
-                print(f'File {csv_filename} does not exist, creating a new one.')
+    if not candidates:
+        log.info("No files to upload.")
+        return
+
+    try:
+        # Step 6: Compare the remaining CSVs with the files on the branch.
+        head_sha, tree_sha, remote_files = fetch_branch_tree(session)
+        changed = {}
+        for symbol, content in candidates.items():
+            config = configs[symbol]
+            if git_blob_sha(content) == remote_files.get(config.csv_filename):
+                log.info("File %s has no changes, skipping upload.", config.csv_filename)
+                save_digest(config.digest_filename, content)
             else:
-                print(f'Unexpected error while accessing {csv_filename}: {response_json}')
-                continue
+                changed[symbol] = content
 
-            # Step 6: Read the new CSV file and encode it in base64.
-            with open(csv_filename, 'rb') as f:
-                content = f.read()
-            content_base64 = base64.b64encode(content).decode('utf-8')
-
-            # Step 7: Create the payload for the GitHub API request.
-            commit_message = f'Update {sanitized_symbol} stock data'
-            payload = {
-                'message': commit_message,
-                'content': content_base64,
-                'branch': branch
+        if not changed:
+            log.info("No files to upload.")
+            return
+
+        # Step 7: Upload the changed CSVs as blobs, in parallel threads since
+        # each upload is a network round trip.
+        with ThreadPoolExecutor(max_workers=len(changed)) as executor:
+            blob_futures = {
+                configs[symbol].csv_filename: executor.submit(create_blob, session, content)
+                for symbol, content in changed.items()
             }
-            if sha:
-                payload['sha'] = sha
+            blobs = {csv_filename: future.result() for csv_filename, future in blob_futures.items()}
 
-            # Step 8: Push the file to the repository.
-            response = requests.put(url, headers=headers, json=payload)
-            if response.status_code in [200, 201]:
-                print(f'File {csv_filename} updated successfully in the repository.')
-            else:
-                print(f'Failed to update the file {csv_filename} in the repository.')
-                print('Response:', response.json())
+        # Step 8: Commit all the blobs at once and move the branch to the new commit.
+        commit_message = COMMIT_MESSAGE.format(', '.join(configs[symbol].name for symbol in changed))
+        commit_sha = commit_blobs(session, head_sha, tree_sha, blobs, commit_message)
+        log.info("Files %s updated successfully in the repository (%s).", ', '.join(blobs), commit_sha)
 
-        except Exception as e:
-            print(f'An error occurred while processing symbol {symbol}: {e}')
+        for symbol, content in changed.items():
+            save_digest(configs[symbol].digest_filename, content)
+
+    except Exception as e:
+        log.error("An error occurred while uploading to %s: %s", REPO, e)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv('LOGLEVEL', 'INFO'),
+                        format='%(asctime)s %(levelname)s %(message)s')
     main()